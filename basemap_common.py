@@ -0,0 +1,186 @@
+import os
+import math
+import subprocess
+import json
+import logging
+import shutil
+import sqlite3
+import threading
+from tqdm import tqdm
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+def run_command(command):
+    logging.info(f"Running command: {' '.join(command)}")
+    # Stream output as it arrives so long GDAL runs show progress and never fill a pipe buffer
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
+        for line in proc.stdout:
+            logging.info(line.rstrip())
+    result = subprocess.CompletedProcess(command, proc.returncode)
+    if result.returncode != 0:
+        logging.error(f"Command failed with exit code {result.returncode}")
+    else:
+        logging.info("Command completed successfully")
+    return result
+
+def mbtiles_native_zoom(mbtiles_path):
+    """Zoom level the MBTiles driver actually wrote, from the file's Web Mercator pixel size"""
+    gdalinfo = json.loads(subprocess.check_output(['gdalinfo', '-json', mbtiles_path], universal_newlines=True))
+    pixel_size = gdalinfo['geoTransform'][1]
+    # 156543.03 m is the zoom 0 resolution of 256px Web Mercator tiles; each zoom level halves it
+    return round(math.log2(156543.03392804097 / pixel_size))
+
+def mbtiles_overview_factors(mbtiles_path, min_zoom, native_zoom=None):
+    """Overview factors that fill the MBTiles pyramid from its native zoom level down to min_zoom"""
+    if native_zoom is None:  # Callers that already know it skip a second gdalinfo run
+        native_zoom = mbtiles_native_zoom(mbtiles_path)
+    return [str(2 ** k) for k in range(1, native_zoom - min_zoom + 1)]
+
+class ProcessTracker:
+    def __init__(self, output_dir):
+        # One row per completed URL; WAL keeps each insert a small append instead of a file rewrite
+        self.progress_db = os.path.join(output_dir, 'download_progress.db')
+        self.legacy_progress_files = [
+            os.path.join(output_dir, 'download_progress.txt'),
+            os.path.join(output_dir, 'download_progress.json'),
+        ]
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.progress_db, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS done (url TEXT PRIMARY KEY)')
+        # Signed URLs are bearer credentials and are kept in memory only; purge any an older version stored
+        self.conn.execute('DROP TABLE IF EXISTS signed')
+        self.migrate_legacy_progress()
+        self.completed_urls = self.load_progress()
+
+    def load_progress(self):
+        return {url for (url,) in self.conn.execute('SELECT url FROM done')}
+
+    def read_legacy_progress(self, path):
+        with open(path, 'r') as f:
+            if path.endswith('.json'):
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError:
+                    logging.warning("Legacy progress file is corrupted, ignoring it")
+                    return []
+            # A crash mid-append leaves at most a truncated last line, which never matches a real URL
+            return [line.strip() for line in f if line.strip()]
+
+    def migrate_legacy_progress(self):
+        # Import in one transaction before removing the old files so a crash never loses progress
+        for path in self.legacy_progress_files:
+            if not os.path.exists(path):
+                continue
+            urls = self.read_legacy_progress(path)
+            with self.conn:
+                self.conn.execute('BEGIN')
+                self.conn.executemany('INSERT OR IGNORE INTO done VALUES (?)', ((url,) for url in urls))
+            os.remove(path)
+
+    def mark_completed(self, url):
+        with self.lock:
+            self.completed_urls.add(url)
+            self.conn.execute('INSERT OR IGNORE INTO done VALUES (?)', (url,))
+
+    def is_completed(self, url):
+        return url in self.completed_urls
+
+def create_retry_session(retries=3, backoff_factor=1.0, backoff_jitter=1.0, backoff_max=60, pool_connections=16, pool_maxsize=32):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_jitter,  # Randomize delays so parallel workers don't retry in lockstep
+        backoff_max=backoff_max,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(['HEAD', 'GET', 'POST']),
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# requests has no session-wide timeout, so every call passes (connect, read) seconds explicitly
+HTTP_TIMEOUT = (30, 600)  # Generous read timeout for large files
+
+# Shared by the STAC search and every download worker so connections stay pooled
+_SESSION = create_retry_session(retries=6)
+
+def _read_partial_source(source_path):
+    try:
+        with open(source_path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def download_tif(url, output_path, session=_SESSION, max_resumes=3):
+    # Transient failures (connection errors, 429/5xx, Retry-After) are retried by the session's Retry policy.
+    # A stream that drops mid-transfer is resumed from the bytes already on disk with a Range request.
+    # output_path names are reused across runs for different images, so a sidecar records which URL (and
+    # which version of it, via If-Range) the partial bytes belong to; anything else is started over.
+    source_path = output_path + '.source'
+    for attempt in range(max_resumes + 1):
+        have = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        source = _read_partial_source(source_path) if have else {}
+        if have and source.get('url') != url:
+            logging.info(f"Discarding {output_path}: it belongs to a different download")
+            have = 0
+        headers = {}
+        if have:
+            headers['Range'] = f'bytes={have}-'
+            if source.get('validator'):
+                headers['If-Range'] = source['validator']  # Server sends the whole file if it changed
+        try:
+            if have:
+                logging.info(f"Resuming download of {url} from {have / (1024*1024):.2f} MB")
+            else:
+                logging.info(f"Downloading high-quality imagery from {url}")
+            response = session.get(url, stream=True, headers=headers, timeout=HTTP_TIMEOUT)
+            if have and response.status_code == 416:
+                logging.info(f"{output_path} is already fully downloaded")
+                os.remove(source_path)
+                return True
+            response.raise_for_status()
+            if response.status_code != 206:
+                have = 0  # Server ignored the Range header, or the file changed; start over
+                with open(source_path, 'w') as f:
+                    json.dump({
+                        'url': url,
+                        'validator': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                    }, f)
+            content_length = int(response.headers.get('content-length', 0))
+            
+            # Copy in 1 MiB blocks inside shutil rather than a per-chunk Python loop
+            response.raw.decode_content = True
+            with open(output_path, 'ab' if have else 'wb') as file, tqdm.wrapattr(
+                response.raw, 'read',
+                desc=output_path,
+                initial=have,
+                total=have + content_length,
+            ) as raw:
+                shutil.copyfileobj(raw, file, length=1024 * 1024)
+            os.remove(source_path)
+            
+            # Verify the file was downloaded correctly
+            if os.path.getsize(output_path) > 0:
+                logging.info(f"Successfully downloaded {os.path.getsize(output_path) / (1024*1024):.2f} MB to {output_path}")
+                return True
+
+            logging.error("Downloaded file is empty. Moving to next file.")
+            os.remove(output_path)
+            return False
+
+        except (ProtocolError, ReadTimeoutError, requests.exceptions.ChunkedEncodingError) as e:
+            # Only a stream dropped mid-transfer is resumed; request-level failures already had the session's retries
+            logging.error(f"Download attempt {attempt + 1} interrupted: {e}")
+        except requests.RequestException as e:
+            logging.error(f"Download failed after retries: {e}")
+            return False
+
+    logging.error("Max resume attempts reached. Keeping partial file so the next run can resume it.")
+    return False
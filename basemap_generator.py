@@ -1,99 +1,24 @@
 import os
 import subprocess
-from tqdm import tqdm
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
-import json
-import time
+import multiprocessing
+import threading
 from datetime import datetime
 import glob
 import logging
-import shutil
+import sqlite3
+from contextlib import closing
+from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from basemap_common import HTTP_TIMEOUT, ProcessTracker, _SESSION, download_tif, mbtiles_overview_factors, run_command
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+gdal.UseExceptions()
 
-def run_command(command):
-    logging.info(f"Running command: {' '.join(command)}")
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        logging.error(f"Command failed with error: {result.stderr}")
-    else:
-        logging.info("Command completed successfully")
-    return result
+# GDAL block cache shared by all processing workers; it also serves the warper while tiles are written
+GDAL_CACHE_BYTES = 4096 * 1024 * 1024
 
-class ProcessTracker:
-    def __init__(self, output_dir):
-        self.progress_file = os.path.join(output_dir, 'download_progress.json')
-        self.completed_urls = self.load_progress()
-
-    def load_progress(self):
-        if os.path.exists(self.progress_file):
-            with open(self.progress_file, 'r') as f:
-                return set(json.load(f))
-        return set()
-
-    def save_progress(self):
-        with open(self.progress_file, 'w') as f:
-            json.dump(list(self.completed_urls), f)
-
-    def mark_completed(self, url):
-        self.completed_urls.add(url)
-        self.save_progress()
-
-    def is_completed(self, url):
-        return url in self.completed_urls
-
-def create_retry_session(retries=3, backoff_factor=0.3, timeout=300):
-    session = requests.Session()
-    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    session.timeout = timeout
-    return session
-
-def download_tif(url, output_path, max_retries=3):
-    session = create_retry_session(retries=5, timeout=600)  # Increased timeout for large files
-    for attempt in range(max_retries):
-        try:
-            logging.info(f"Downloading high-quality imagery from {url}")
-            response = session.get(url, stream=True)
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            
-            with open(output_path, 'wb') as file, tqdm(
-                desc=output_path,
-                total=total_size,
-                unit='iB',
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as progress_bar:
-                for data in response.iter_content(chunk_size=8192):  # Larger chunk size for efficiency
-                    size = file.write(data)
-                    progress_bar.update(size)
-            
-            # Verify the file was downloaded correctly
-            if os.path.getsize(output_path) > 0:
-                logging.info(f"Successfully downloaded {os.path.getsize(output_path) / (1024*1024):.2f} MB to {output_path}")
-                return True
-            else:
-                logging.error("Downloaded file is empty. Retrying...")
-                if os.path.exists(output_path):
-                    os.remove(output_path)
-                continue
-                
-        except requests.RequestException as e:
-            logging.error(f"Download attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 5
-                logging.info(f"Waiting {wait_time} seconds before retry...")
-                time.sleep(wait_time)
-            else:
-                logging.error("Max retries reached. Moving to next file.")
-                return False
-
-def get_tif_urls():
+def get_tif_urls(session=_SESSION):
     """Get direct NAIP TIF URLs for a specific area in Kentucky"""
     stac_search_url = "https://planetarycomputer.microsoft.com/api/stac/v1/search"
     
@@ -114,8 +39,8 @@ def get_tif_urls():
     }
 
     all_urls = []
+    seen_urls = set()
     latest_year = None
-    session = create_retry_session()
 
     # Focus on getting the highest quality imagery
     search_params = {
@@ -130,7 +55,7 @@ def get_tif_urls():
     }
 
     try:
-        response = session.post(stac_search_url, json=search_params)
+        response = session.post(stac_search_url, json=search_params, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         
         logging.info(f"API Response Status Code: {response.status_code}")
@@ -139,21 +64,26 @@ def get_tif_urls():
         logging.info(f"Number of features found: {len(features)}")
         
         if features:
-            sorted_features = sorted(features, key=lambda x: x['properties']['datetime'], reverse=True)
+            # Parse each timestamp once; fromisoformat is much cheaper than strptime
+            dated_features = sorted(
+                ((datetime.fromisoformat(f['properties']['datetime'].rstrip('Z')), f) for f in features),
+                key=lambda item: item[0],
+                reverse=True,
+            )
 
             if latest_year is None:
-                latest_year = datetime.strptime(sorted_features[0]['properties']['datetime'], '%Y-%m-%dT%H:%M:%SZ').year
+                latest_year = dated_features[0][0].year
             
             logging.info(f"Latest year: {latest_year}")
 
-            region_features = [f for f in sorted_features 
-                           if datetime.strptime(f['properties']['datetime'], '%Y-%m-%dT%H:%M:%SZ').year == latest_year]
+            region_features = [f for dt, f in dated_features if dt.year == latest_year]
 
             logging.info(f"Number of features for the latest year: {len(region_features)}")
 
             for feature in region_features:
                 url = feature['assets']['image']['href']
-                if url not in all_urls:
+                if url not in seen_urls:
+                    seen_urls.add(url)
                     all_urls.append(url)
                     
             logging.info(f"Number of unique URLs found: {len(all_urls)}")
@@ -163,175 +93,193 @@ def get_tif_urls():
 
     return all_urls
 
+def _process_one(i, url, input_tif, output_dir, total, cache_bytes, num_threads):
+    """Run Steps 2-7 for one downloaded image with this worker's share of the GDAL cache and CPUs"""
+    logging.info(f"Processing image {i} of {total}")
+    
+    # Step 2: Check band statistics to determine if we need to reorder bands
+    logging.info(f"Analyzing band statistics to determine correct RGB order")
+    try:
+        src_ds = gdal.Open(input_tif)
+    except RuntimeError as e:
+        logging.error(f"Could not open {input_tif}: {e}. Skipping.")
+        return None
+
+    # Default band order (standard RGB)
+    band_order = [1, 2, 3]
+    try:
+        if src_ds.RasterCount >= 3:
+            # Check statistics to detect potential band swapping. Approximate stats come from
+            # the COG's overviews, which is plenty for this check and avoids a full-resolution read
+            means = [src_ds.GetRasterBand(b).GetStatistics(True, True)[2] for b in range(1, 4)]
+            
+            logging.info(f"Band means: {means}")
+            
+            # Common pattern for swapped colors:
+            # If blue mean (band 3) is higher than red mean (band 1), 
+            # there's likely a swap
+            if means[2] > means[0] * 1.2:
+                logging.info(f"Detected likely RGB/BGR swap, applying correction")
+                band_order = [3, 2, 1]  # BGR to RGB swap
+        
+        logging.info(f"Using band order: {band_order}")
+    
+    except RuntimeError as e:
+        logging.warning(f"Error analyzing band statistics: {e}")
+    
+    # Steps 3-5 are chained through in-memory VRTs, so pixels stream straight
+    # from input_tif into the MBTiles encoder without intermediate GeoTIFFs
+    band_vrt = f"/vsimem/band_{i}.vrt"
+    warped_vrt = f"/vsimem/warped_{i}.vrt"
+    final_mbtiles = os.path.join(output_dir, f"naip_tile_{i}.mbtiles")
+    try:
+        # Step 3: Select bands in the corrected RGB order, reusing the dataset opened for the statistics
+        logging.info(f"Creating color-corrected band view with band order {band_order}")
+        gdal.Translate(band_vrt, src_ds, format='VRT', bandList=band_order)
+        src_ds = None
+
+        # Step 4: Reproject and downsample to 1m resolution
+        logging.info(f"Reprojecting and resampling to 1m resolution")
+        gdal.Warp(
+            warped_vrt, band_vrt,
+            format='VRT',
+            resampleAlg='lanczos',        # Best quality resampling algorithm
+            dstSRS='EPSG:3857',           # Web Mercator projection
+            xRes=1.0, yRes=1.0,           # 1-meter resolution as requested
+            targetAlignedPixels=True,     # Align pixels to the target resolution
+            multithread=True,             # Use multithreading
+            warpOptions=[f'NUM_THREADS={num_threads}'],
+            dstNodata=0,
+        )
+
+        # Step 5: Create high-quality MBTiles with consistent color
+        logging.info(f"Creating high-quality MBTiles with zoom levels 1-16")
+        # The warped VRT is evaluated while the tiles are written, so this cache also serves the
+        # warper: a larger one keeps more source blocks resident instead of re-decompressing them
+        gdal.SetCacheMax(cache_bytes)
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', str(num_threads))  # Encode tiles on this worker's CPUs
+        gdal.Translate(
+            final_mbtiles, warped_vrt,
+            format='MBTILES',
+            creationOptions=[
+                'TILE_FORMAT=JPEG',       # JPEG format as in your original script
+                'QUALITY=100',            # Max quality for JPEG tiles
+                'RESAMPLING=CUBIC',       # Cubic resampling as in your original script
+                'MINZOOM=1',              # Min zoom level 1 as requested
+                'MAXZOOM=16',             # Max zoom level 16 as requested
+            ],
+            metadataOptions=['minzoom=1', 'maxzoom=16'],
+        )
+    except RuntimeError as e:
+        logging.error(f"Failed to create MBTiles for image {i}: {e}. Skipping.")
+        return None
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+        src_ds = None  # Close the input before it is removed
+        for vrt in (band_vrt, warped_vrt):
+            if gdal.VSIStatL(vrt) is not None:
+                gdal.Unlink(vrt)
+    
+    # Step 6: Add optimized overviews for better performance
+    logging.info(f"Adding overviews for zoom levels")
+    gdaladdo_mbtiles_command = [
+        'gdaladdo', 
+        '-r', 'lanczos',              # Use lanczos for highest quality overviews
+        '--config', 'COMPRESS_OVERVIEW', 'LZW',
+        '--config', 'GDAL_NUM_THREADS', str(num_threads),  # Use this worker's share of the CPUs
+        final_mbtiles,
+    ]
+    # Only the factors that map onto zoom levels between the native level and MINZOOM
+    gdaladdo_mbtiles_command.extend(mbtiles_overview_factors(final_mbtiles, min_zoom=1))
+    
+    if run_command(gdaladdo_mbtiles_command).returncode != 0:
+        logging.warning(f"Adding overviews to MBTiles for image {i} failed, but continuing.")
+    
+    # Step 7: Verify the output has tiles and fix metadata if needed
+    logging.info(f"Verifying MBTiles quality and integrity")
+    with closing(sqlite3.connect(final_mbtiles)) as conn, conn:
+        tile_count = conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        logging.info(f"MBTiles contains {tile_count} tiles")
+        # The MBTiles driver rewrites minzoom/maxzoom from the levels it built,
+        # so pin the advertised range with both updates in one transaction
+        conn.executemany(
+            "UPDATE metadata SET value=? WHERE name=?",
+            [('1', 'minzoom'), ('16', 'maxzoom')],
+        )
+    
+    if tile_count == 0:
+        logging.error(f"MBTiles for image {i} has no tiles. Skipping.")
+        return None
+    
+    # Clean up intermediate files
+    if os.path.exists(input_tif):
+        os.remove(input_tif)
+    
+    logging.info(f"✅ Successfully processed image {i}/{total} with correct colors and quality")
+    return url
+
 def process_tifs(tif_urls, output_dir):
     os.makedirs(output_dir, exist_ok=True)
     tracker = ProcessTracker(output_dir)
 
+    pending = []
     for i, url in enumerate(tif_urls, 1):
         if tracker.is_completed(url):
             logging.info(f"Skipping already completed image {i} of {len(tif_urls)}")
             continue
+        pending.append((i, url, os.path.join(output_dir, f"input_{i}.tif")))
 
-        logging.info(f"Processing image {i} of {len(tif_urls)}")
-        
-        # Define all file paths we'll need
-        input_tif = os.path.join(output_dir, f"input_{i}.tif")
-        
-        # Step 1: Download the TIF
-        if not download_tif(url, input_tif):
+    # Step 1 downloads run on threads over the shared session while Steps 2-7 run in worker
+    # processes; each image is handed to a processor as soon as its download finishes, so
+    # GDAL work on one image overlaps the downloads of the others. Each GDAL step is
+    # multithreaded, so keep the process fan-out small and split the cores between them.
+    max_workers = int(os.environ.get('NAIP_CONCURRENCY', '8'))
+    max_processes = max(1, min(len(pending), (os.cpu_count() or 1) // 4))
+    # Each worker process has its own GDAL cache and thread pool, so divide both between them
+    cache_bytes = GDAL_CACHE_BYTES // max_processes
+    num_threads = max(1, (os.cpu_count() or 1) // max_processes)
+    # A TIF sits on disk from the start of its download until its processing finishes, so each
+    # image holds a slot for that whole span: every processor busy plus two TIFs ready or in flight
+    slots = threading.BoundedSemaphore(max_processes + 2)
+    # Spawn rather than fork: download threads are still running when workers start
+    mp_context = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=max_workers) as downloader, \
+            ProcessPoolExecutor(max_workers=max_processes, mp_context=mp_context) as processor:
+
+        def download_and_submit(i, url, input_tif):
+            # Runs on a download thread; returns the processing future, or None if the download failed
+            try:
+                if download_tif(url, input_tif, _SESSION):
+                    future = processor.submit(_process_one, i, url, input_tif, output_dir, len(tif_urls),
+                                              cache_bytes, num_threads)
+                    future.add_done_callback(lambda _: slots.release())
+                    return future
+            except Exception as e:
+                logging.error(f"Unexpected error downloading {url}: {e}")
             logging.error(f"Failed to download TIF for URL {url}. Skipping.")
-            continue
-        
-        # Step 2: Check band statistics to determine if we need to reorder bands
-        logging.info(f"Analyzing band statistics to determine correct RGB order")
-        try:
-            # Get band statistics to identify potential swapped bands
-            stats_command = ['gdalinfo', '-stats', '-json', input_tif]
-            stats_result = subprocess.run(stats_command, capture_output=True, text=True)
-            
-            # Default band order (standard RGB)
-            band_order = [1, 2, 3]
-            
-            if stats_result.returncode == 0:
-                import json
-                try:
-                    stats = json.loads(stats_result.stdout)
-                    bands = stats.get('bands', [])
-                    
-                    if len(bands) >= 3:
-                        # Check statistics to detect potential band swapping
-                        means = []
-                        for band in bands[:3]:
-                            stats_data = band.get('stats', {})
-                            mean = stats_data.get('mean', 0)
-                            means.append(mean)
-                        
-                        logging.info(f"Band means: {means}")
-                        
-                        # Common pattern for swapped colors:
-                        # If blue mean (band 3) is higher than red mean (band 1), 
-                        # there's likely a swap
-                        if len(means) == 3 and means[2] > means[0] * 1.2:
-                            logging.info(f"Detected likely RGB/BGR swap, applying correction")
-                            band_order = [3, 2, 1]  # BGR to RGB swap
-                except json.JSONDecodeError:
-                    logging.warning("Could not parse band statistics JSON")
-            
-            logging.info(f"Using band order: {band_order}")
-        
-        except Exception as e:
-            logging.warning(f"Error analyzing band statistics: {e}")
-            # Default to standard RGB order
-            band_order = [1, 2, 3]
-        
-        # Step 3: Create a corrected intermediate TIFF with proper RGB bands
-        corrected_tif = os.path.join(output_dir, f"corrected_{i}.tif")
-        
-        color_fix_command = [
-            'gdal_translate',
-            '-of', 'GTiff',
-            '-co', 'COMPRESS=LZW',
-            '-co', 'PHOTOMETRIC=RGB',
-        ]
-        
-        # Add band selection based on the determined order
-        for band in band_order:
-            color_fix_command.extend(['-b', str(band)])
-        
-        color_fix_command.extend([input_tif, corrected_tif])
-        
-        logging.info(f"Creating color-corrected image with band order {band_order}")
-        run_command(color_fix_command)
-            
-        # Step 4: Reproject and downsample to 1m resolution
-        resampled_tif = os.path.join(output_dir, f"resampled_{i}.tif")
-        gdalwarp_command = [
-            'gdalwarp',
-            '-r', 'lanczos',              # Best quality resampling algorithm
-            '-of', 'GTiff',
-            '-co', 'COMPRESS=LZW',        # LZW compression preserves quality better than JPEG
-            '-co', 'TILED=YES',
-            '-co', 'BLOCKXSIZE=256',
-            '-co', 'BLOCKYSIZE=256',
-            '-co', 'PREDICTOR=2',         # Predictor improves compression while maintaining quality
-            '-co', 'BIGTIFF=YES',         # Support for large files
-            '-co', 'PHOTOMETRIC=RGB',     # Force RGB color interpretation
-            '-t_srs', 'EPSG:3857',        # Web Mercator projection
-            '-tr', '1.0', '1.0',          # 1-meter resolution as requested
-            '-tap',                       # Align pixels to the target resolution
-            '-multi',                     # Use multithreading
-            '-wo', 'NUM_THREADS=ALL_CPUS',
-            '-dstnodata', '0',
-            corrected_tif,
-            resampled_tif
-        ]
-        
-        logging.info(f"Reprojecting and resampling to 1m resolution")
-        if run_command(gdalwarp_command).returncode != 0:
-            logging.error(f"Failed to resample image {i}. Skipping.")
-            continue
-        
-        # Step 5: Create high-quality MBTiles with consistent color
-        final_mbtiles = os.path.join(output_dir, f"naip_tile_{i}.mbtiles")
-        gdal_translate_command = [
-            'gdal_translate', 
-            '-of', 'MBTILES',
-            '-co', 'TILE_FORMAT=JPEG',    # JPEG format as in your original script
-            '-co', 'QUALITY=100',         # Max quality for JPEG tiles
-            '-co', 'RESAMPLING=CUBIC',    # Cubic resampling as in your original script
-            '-co', 'MINZOOM=1',           # Min zoom level 1 as requested
-            '-co', 'MAXZOOM=16',          # Max zoom level 16 as requested
-            '-mo', 'minzoom=1',           # Set metadata minzoom
-            '-mo', 'maxzoom=16',          # Set metadata maxzoom
-            '--config', 'GDAL_CACHEMAX', '1024',  # Increase cache for better processing
-            resampled_tif, 
-            final_mbtiles
-        ]
-        
-        logging.info(f"Creating high-quality MBTiles with zoom levels 1-16")
-        if run_command(gdal_translate_command).returncode != 0:
-            logging.error(f"Failed to create MBTiles for image {i}. Skipping.")
-            continue
-        
-        # Step 6: Add optimized overviews for better performance
-        logging.info(f"Adding overviews for zoom levels")
-        gdaladdo_mbtiles_command = [
-            'gdaladdo', 
-            '-r', 'lanczos',              # Use lanczos for highest quality overviews
-            '--config', 'COMPRESS_OVERVIEW', 'LZW',
-            '--config', 'GDAL_NUM_THREADS', 'ALL_CPUS',  # Use all CPUs for faster processing
-            final_mbtiles,
-            # Overview factors appropriate for zoom levels
-            '2', '4', '8', '16', '32', '64', '128', '256', '512', '1024', '2048', '4096', '8192'
-        ]
-        
-        if run_command(gdaladdo_mbtiles_command).returncode != 0:
-            logging.warning(f"Adding overviews to MBTiles for image {i} failed, but continuing.")
-        
-        # Step 7: Verify the output quality and file integrity
-        logging.info(f"Verifying MBTiles quality and integrity")
-        verify_command = ['gdalinfo', final_mbtiles]
-        verify_result = run_command(verify_command)
-        
-        # Fix metadata if needed
-        fix_zoom_metadata = [
-            'sqlite3', final_mbtiles, 
-            "UPDATE metadata SET value='1' WHERE name='minzoom'; UPDATE metadata SET value='16' WHERE name='maxzoom';"
-        ]
-        subprocess.run(fix_zoom_metadata, capture_output=True)
-        
-        # Clean up intermediate files
-        if os.path.exists(input_tif):
-            os.remove(input_tif)
-        if os.path.exists(corrected_tif):
-            os.remove(corrected_tif)
-        if os.path.exists(resampled_tif):
-            os.remove(resampled_tif)
-        
-        # Mark this URL as completed
-        tracker.mark_completed(url)
-        
-        logging.info(f"✅ Successfully processed image {i}/{len(tif_urls)} with correct colors and quality")
+            slots.release()
+            return None
+
+        download_futures = {}
+        for i, url, input_tif in pending:
+            slots.acquire()
+            download_futures[downloader.submit(download_and_submit, i, url, input_tif)] = url
+
+        process_futures = {}
+        for future in as_completed(download_futures):
+            process_future = future.result()
+            if process_future is not None:
+                process_futures[process_future] = download_futures[future]
+
+        for future in as_completed(process_futures):
+            try:
+                completed_url = future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error processing {process_futures[future]}: {e}")
+                continue
+            if completed_url:
+                # Mark this URL as completed
+                tracker.mark_completed(completed_url)
     
     logging.info(f"🎉 All processing complete! High-quality MBTiles (zoom levels 1-16) created in {output_dir}")
     
@@ -1,24 +1,49 @@
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
 from tqdm import tqdm
-import json
 import os
 import subprocess
-from datetime import datetime
 import time
 import threading
 import signal
 import sys
 import sqlite3
 import re
+import shutil
 import traceback
-
-import json
 from datetime import datetime
-import requests
-
-def get_tif_urls():
+from urllib.parse import urlparse
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from basemap_common import HTTP_TIMEOUT, ProcessTracker, _SESSION, mbtiles_native_zoom, mbtiles_overview_factors
+
+# GDAL settings for range-reading remote COGs over /vsicurl/ without probing for sidecar files
+VSICURL_ENV = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': '1073741824',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_VERSION': '2',
+}
+
+# Let GDAL use every core and a 4 GiB block cache while tiling; the tiling steps run one at a time
+TILING_ENV = {
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'GDAL_CACHEMAX': '4096',
+}
+
+# Overviews are built this many zoom levels below the native one, but never below MIN_OVERVIEW_ZOOM
+MAX_OVERVIEW_LEVELS = 4
+MIN_OVERVIEW_ZOOM = 10
+
+# GDAL reads /vsicurl/ sources for the whole tiling run, so their signature must outlive it;
+# longer runs should download the TIFs (NAIP_DOWNLOAD_TIFS=1) or use AZURE_STORAGE_SAS_TOKEN
+TILING_TOKEN_TTL = int(os.environ.get('NAIP_TILING_TOKEN_TTL', 1800))
+
+# Copy buffer for single-stream downloads; each read is at most this size, so the stall watcher
+# sees progress after every MiB rather than only once a large buffer fills on a slow link
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+def get_tif_urls(session=_SESSION):
     """Get direct NAIP TIF URLs for a specific area in Kentucky"""
     stac_search_url = "https://planetarycomputer.microsoft.com/api/stac/v1/search"
     
@@ -40,8 +65,8 @@ def get_tif_urls():
     }
 
     all_urls = []
-    latest_year = None
-    session = create_retry_session()
+    seen_urls = set()
+    features_by_id = {}
 
     search_params = {
         "collections": ["naip"],
@@ -54,36 +79,83 @@ def get_tif_urls():
     }
 
     try:
-        response = session.post(stac_search_url, json=search_params)
+        response = session.post(stac_search_url, json=search_params, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         
-        features = response.json().get('features', [])
-        if features:
-            sorted_features = sorted(features, key=lambda x: x['properties']['datetime'], reverse=True)
+        for feature in response.json().get('features', []):
+            features_by_id.setdefault(feature['id'], feature)
 
-            if latest_year is None:
-                latest_year = datetime.strptime(sorted_features[0]['properties']['datetime'], '%Y-%m-%dT%H:%M:%SZ').year
+        if features_by_id:
+            # Only the year is needed, so read it from the ISO-8601 prefix instead of parsing each datetime
+            years = {feature_id: int(f['properties']['datetime'][:4]) for feature_id, f in features_by_id.items()}
+            latest_year = max(years.values())
 
-            region_features = [f for f in sorted_features 
-                           if datetime.strptime(f['properties']['datetime'], '%Y-%m-%dT%H:%M:%SZ').year == latest_year]
-
-            for feature in region_features:
+            for feature_id, feature in features_by_id.items():
+                if years[feature_id] != latest_year:
+                    continue
                 url = feature['assets']['image']['href']
-                if url not in all_urls:
+                if url not in seen_urls:
+                    seen_urls.add(url)
                     all_urls.append(url)
                     
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data: {e}")
 
     return all_urls
-class DownloadTimeout(Exception):
+class DownloadInterrupted(Exception):
+    """The transfer dropped mid-stream, after the session's Retry policy had already handed over the response"""
+
+class DownloadTimeout(DownloadInterrupted):
     pass
 
-def download_with_timeout(session, url, filename, timeout=300, chunk_size=1024*1024):
-    """Download with timeout for each chunk"""
+def request_signed(session, method, url, refresh_url=None, **kwargs):
+    """Send a request; if the URL's signature has expired (403), re-sign it once via refresh_url and retry"""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    response = session.request(method, url, **kwargs)
+    if response.status_code == 403 and refresh_url is not None:
+        response.close()
+        url = refresh_url(url)
+        response = session.request(method, url, **kwargs)
+    return response, url
+
+def download_with_timeout(session, url, filename, timeout=300, chunk_size=1024*1024, num_parts=8, refresh_url=None):
+    """Download with timeout for each chunk, fetching byte ranges in parallel when the server supports it"""
+    head, url = request_signed(session, 'HEAD', url, refresh_url, allow_redirects=True)
+    head.raise_for_status()
+    total_size = int(head.headers.get('content-length', 0))
+    if total_size and head.headers.get('accept-ranges', '').lower() == 'bytes' and num_parts > 1:
+        return download_ranges(session, url, filename, total_size, timeout, chunk_size, num_parts, refresh_url)
+    return download_stream(session, url, filename, timeout, refresh_url=refresh_url)
+
+def download_stream(session, url, filename, timeout=300, buffer_size=STREAM_BUFFER_SIZE, refresh_url=None):
+    """Download over a single stream, with a watcher thread reporting progress and enforcing the stall timeout"""
+    progress_bar = None
+    response = None
+    finished = threading.Event()
+    stalled = threading.Event()
+
+    def watch():
+        reported = 0
+        last_update = time.time()
+        while not finished.wait(1):
+            # Bytes received from the socket, so progress shows before the file buffer is flushed
+            size = response.raw.tell()
+            if size > reported:
+                progress_bar.update(size - reported)
+                reported = size
+                last_update = time.time()
+            elif time.time() - last_update > timeout:
+                # Closing the response fails the copy on its next read; a read already blocked on a
+                # silent socket isn't woken by this and ends with the stream's read timeout instead
+                stalled.set()
+                response.close()
+                return
+
     try:
-        response = session.get(url, stream=True)
+        # Read timeout matches the stall timeout, so a silent socket fails after timeout seconds, not HTTP_TIMEOUT's
+        response, url = request_signed(session, 'GET', url, refresh_url, stream=True, timeout=(HTTP_TIMEOUT[0], timeout))
         response.raise_for_status()
+        response.raw.decode_content = True
         total_size = int(response.headers.get('content-length', 0))
         
         progress_bar = tqdm(
@@ -93,222 +165,296 @@ def download_with_timeout(session, url, filename, timeout=300, chunk_size=1024*1
             unit_divisor=1024,
         )
 
-        downloaded = 0
-        last_update = time.time()
-        
-        with open(filename, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    current_time = time.time()
-                    # Check if we've gone too long without progress
-                    if current_time - last_update > timeout:
-                        raise DownloadTimeout(f"No progress for {timeout} seconds")
-                    
-                    f.write(chunk)
-                    size = len(chunk)
-                    downloaded += size
-                    progress_bar.update(size)
-                    last_update = current_time
-                    
+        with open(filename, 'wb', buffering=buffer_size) as f:
+            watcher = threading.Thread(target=watch, daemon=True)
+            watcher.start()
+            try:
+                shutil.copyfileobj(response.raw, f, length=buffer_size)
+            except (ProtocolError, ReadTimeoutError) as e:
+                if not stalled.is_set():
+                    raise DownloadInterrupted(e) from e
+            except Exception:
+                if not stalled.is_set():
+                    raise
+            finally:
+                finished.set()
+                watcher.join()
+
+            if stalled.is_set():
+                raise DownloadTimeout(f"No progress for {timeout} seconds")
+            progress_bar.update(response.raw.tell() - progress_bar.n)
+
         progress_bar.close()
         return True
         
     except Exception as e:
-        progress_bar.close()
+        if progress_bar is not None:
+            progress_bar.close()
         if os.path.exists(filename):
             os.remove(filename)
         raise e
 
-def create_retry_session(retries=3, backoff_factor=0.3, timeout=300):
-    """Create a requests session with retry capability and timeouts"""
-    session = requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=(500, 502, 503, 504),
+def download_ranges(session, url, filename, total_size, timeout=300, chunk_size=1024*1024, num_parts=8, refresh_url=None, part_resumes=3):
+    """Download num_parts byte ranges in parallel, each written at its own offset of a preallocated file"""
+    part_size = -(-total_size // num_parts)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+    progress_bar = tqdm(
+        total=total_size,
+        unit='iB',
+        unit_scale=True,
+        unit_divisor=1024,
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    session.timeout = timeout  # Set timeout for the entire session
-    return session
-
-def download_with_progress(url, filename, max_retries=3, timeout=300):
-    """Enhanced download function with timeout and retry logic"""
-    for attempt in range(max_retries):
+    progress_lock = threading.Lock()
+    cancelled = threading.Event()  # Set once any part fails, since the whole file is discarded then
+
+    def fetch_range(fd, start, end):
+        # A part that drops mid-stream resumes from its last written byte, so only that part's remainder is re-fetched
+        offset = start
+        for _ in range(part_resumes + 1):
+            if cancelled.is_set():
+                return
+            # Parts start at different times, so one may find the signature expired and re-sign before fetching its range.
+            # The read timeout makes a silent socket raise instead of blocking forever between chunks.
+            response, _ = request_signed(session, 'GET', url, refresh_url, headers={'Range': f'bytes={offset}-{end}'},
+                                         stream=True, timeout=(HTTP_TIMEOUT[0], timeout))
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.exceptions.RequestException(f"Server ignored range request for bytes {offset}-{end}")
+
+            try:
+                last_update = time.time()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if cancelled.is_set():
+                        return
+                    if chunk:
+                        current_time = time.time()
+                        # Check if we've gone too long without progress
+                        if current_time - last_update > timeout:
+                            raise DownloadTimeout(f"No progress for {timeout} seconds")
+
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        with progress_lock:
+                            progress_bar.update(len(chunk))
+                        last_update = current_time
+                if offset == end + 1:
+                    return
+                error = f"ended early at byte {offset}"
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, DownloadTimeout) as e:
+                error = e
+            finally:
+                response.close()
+            print(f"\nRange {start}-{end} interrupted ({error}), resuming from byte {offset}")
+
+        raise requests.exceptions.RequestException(f"Range {start}-{end} failed after {part_resumes} resumes: {error}")
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except (AttributeError, OSError):
+                # Not available on this platform or filesystem (EOPNOTSUPP); a sparse file works too
+                os.ftruncate(fd, total_size)
+
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [pool.submit(fetch_range, fd, start, end) for start, end in ranges]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # Leaving the pool waits for the other parts, so stop them at their next chunk
+                    # rather than finish downloads that are about to be thrown away
+                    cancelled.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+            progress_bar.close()
+
+    except Exception as e:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise e
+
+    return True
+
+def download_with_progress(url, filename, timeout=300, session=_SESSION, max_attempts=3, refresh_url=None):
+    """Download with timeout; the session's Retry policy only covers getting a response, so a
+    transfer that drops mid-stream is restarted here, up to max_attempts in all"""
+    for attempt in range(1, max_attempts + 1):
         try:
-            session = create_retry_session(timeout=timeout)
-            print(f"\nAttempt {attempt + 1}/{max_retries} for {filename}")
-            
-            download_with_timeout(session, url, filename, timeout=timeout)
+            download_with_timeout(session, url, filename, timeout=timeout, refresh_url=refresh_url)
             return True
-            
-        except DownloadTimeout as e:
-            print(f"\nDownload timed out: {e}")
+
+        except DownloadInterrupted as e:
+            print(f"\nDownload attempt {attempt} of {max_attempts} interrupted: {e}")
             if os.path.exists(filename):
                 os.remove(filename)
-            
+
         except requests.exceptions.RequestException as e:
-            print(f"\nDownload attempt {attempt + 1} failed: {e}")
+            print(f"\nDownload failed after retries: {e}")
             if os.path.exists(filename):
                 os.remove(filename)
-                
+            return False
+
         except Exception as e:
             print(f"\nUnexpected error during download: {e}")
             if os.path.exists(filename):
                 os.remove(filename)
-            
-        if attempt < max_retries - 1:
-            wait_time = (attempt + 1) * 15  # Progressive delay: 15s, 30s, 45s
-            print(f"Waiting {wait_time} seconds before retry...")
-            time.sleep(wait_time)
-        else:
-            print("Max retries reached. Moving to next file.")
             return False
 
-def get_signed_url(url):
-    """Get signed URL with retry capability"""
-    session = create_retry_session()
-    sign_url = f"https://planetarycomputer.microsoft.com/api/sas/v1/sign?href={url}"
-    
-    try:
-        response = session.get(sign_url)
+    return False
+
+# (account, container) -> (SAS token, expiry epoch); one token signs every blob in the container.
+# Tokens are bearer credentials, so they live in memory only and are never written to disk.
+_CONTAINER_TOKENS = {}
+_CONTAINER_TOKENS_LOCK = threading.Lock()
+
+def get_container_token(url, session=_SESSION, min_ttl=60, refresh=False):
+    """Get a SAS token for the URL's storage container, reusing it while it stays valid for min_ttl seconds"""
+    parsed = urlparse(url)
+    key = (get_storage_account(url), parsed.path.lstrip('/').split('/')[0])
+    with _CONTAINER_TOKENS_LOCK:
+        cached = _CONTAINER_TOKENS.get(key)
+        if cached and cached[1] > time.time() + min_ttl and not refresh:
+            return cached
+
+        response = session.get(f"https://planetarycomputer.microsoft.com/api/sas/v1/token/{key[0]}/{key[1]}", timeout=HTTP_TIMEOUT)
         response.raise_for_status()
-        return response.json()['href']
-    except requests.exceptions.RequestException as e:
+        body = response.json()
+        expires = datetime.fromisoformat(body['msft:expiry'].replace('Z', '+00:00')).timestamp()
+        _CONTAINER_TOKENS[key] = (body['token'], expires)
+        if expires <= time.time() + min_ttl:
+            raise ValueError(f"SAS token for {key[0]}/{key[1]} expires in {expires - time.time():.0f}s, need {min_ttl}s")
+        return _CONTAINER_TOKENS[key]
+
+def get_signed_url(url, session=_SESSION, min_ttl=60, refresh=False):
+    """Get signed URL that stays valid for at least min_ttl seconds"""
+    try:
+        token, _ = get_container_token(url, session, min_ttl=min_ttl, refresh=refresh)
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
         print(f"Error getting signed URL: {e}")
         return None
 
-class ProcessTracker:
-    def __init__(self, output_dir):
-        self.progress_file = os.path.join(output_dir, 'download_progress.json')
-        self.lock_file = os.path.join(output_dir, '.processing.lock')
-        self.completed_urls = self.load_progress()
+    return f"{url}?{token}"
 
-    def load_progress(self):
-        if os.path.exists(self.progress_file):
-            try:
-                with open(self.progress_file, 'r') as f:
-                    return set(json.load(f))
-            except json.JSONDecodeError:
-                print("Warning: Progress file corrupted, starting fresh")
-                return set()
-        return set()
-
-    def save_progress(self):
-        temp_file = self.progress_file + '.tmp'
-        with open(temp_file, 'w') as f:
-            json.dump(list(self.completed_urls), f)
-        os.replace(temp_file, self.progress_file)  # Atomic update
-
-    def mark_completed(self, url):
-        self.completed_urls.add(url)
-        self.save_progress()
-
-    def is_completed(self, url):
-        return url in self.completed_urls
+def get_storage_account(url):
+    """Azure storage account that hosts a blob URL"""
+    return urlparse(url).netloc.split('.')[0]
 
-def convert_to_mbtiles(input_tif, output_mbtiles):
-    """Convert TIF to MBTiles with precise bounds and error handling"""
-    tiles_dir = 'tiles_dir'
+def get_vsiaz_path(url, account):
+    """Map a blob URL to its /vsiaz/ path, or None if it isn't in the storage account GDAL is set up for"""
+    if get_storage_account(url) != account:
+        return None
+    return f"/vsiaz{urlparse(url).path}"
 
-    def get_tif_bounds(tif_path):
-        """Extract precise geographic bounds of the input TIF"""
-        try:
-            # Use gdalinfo to get precise bounds
-            result = subprocess.check_output([
-                'gdalinfo', 
-                '-json', 
-                tif_path
-            ], universal_newlines=True)
-            
-            import json
-            gdalinfo = json.loads(result)
-            
-            # Extract bounds from the WGS84 extent
-            extent = gdalinfo.get('wgs84Extent', {}).get('coordinates', [[[0,0,0,0]]])[0]
-            
-            # Flatten coordinates and find min/max
-            lons = [coord[0] for coord in extent]
-            lats = [coord[1] for coord in extent]
-            
-            bounds = [
-                max(-180.0, min(lons)),   # min lon, clamped
-                max(-85.0511, min(lats)),   # min lat, clamped
-                min(180.0, max(lons)),    # max lon, clamped
-                min(85.0511, max(lats))   # max lat, clamped
-            ]
-            
-            return bounds
-        except Exception as e:
-            print(f"Could not extract precise bounds: {e}")
-            return [-180.0, -85.0511, 180.0, 85.0511]
+def _download_one(url, temp_tif):
+    """Sign and download one TIF; returns its local path, or None if signing or the download failed"""
+    signed = {'url': get_signed_url(url)}
+    if not signed['url']:
+        print(f"Could not get signed URL for {url}")
+        return None
+    refresh_lock = threading.Lock()
+
+    def refresh_url(stale_url):
+        # Range parts that hit the same expired signature share a single re-sign
+        with refresh_lock:
+            if signed['url'] == stale_url:
+                signed['url'] = get_signed_url(url, refresh=True) or stale_url
+            return signed['url']
+
+    if download_with_progress(signed['url'], temp_tif, timeout=300, refresh_url=refresh_url) and os.path.exists(temp_tif):
+        return temp_tif
+    return None
+
+def build_mosaic_vrt(sources, vrt_path):
+    """Build a single VRT mosaic over all sources (which must share a projection)"""
+    # Paths go through a list file so thousands of inputs can't overflow the command line
+    list_file = vrt_path + '.txt'
+    try:
+        with open(list_file, 'w') as f:
+            f.writelines(source + '\n' for source in sources)
+        subprocess.run([
+            'gdalbuildvrt',
+            '-overwrite',
+            '-input_file_list', list_file,
+            vrt_path
+        ], check=True, env={**os.environ, **VSICURL_ENV})
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error building mosaic VRT: {e}")
+        return False
+    finally:
+        if os.path.exists(list_file):
+            os.remove(list_file)
 
+def convert_to_mbtiles(input_tif, output_mbtiles):
+    """Convert TIF to MBTiles with GDAL's MBTiles driver and error handling"""
     try:
         # Clean up any existing files
-        if os.path.exists(tiles_dir):
-            subprocess.run(['rm', '-rf', tiles_dir], check=True)
         if os.path.exists(output_mbtiles):
             os.remove(output_mbtiles)
 
-        # Get precise bounds of the input TIF
-        bounds = get_tif_bounds(input_tif)
-        bounds_str = ','.join(map(str, bounds))
-
-        # Generate tiles with precise bounds
+        # Write tiles straight into the MBTiles file; the driver reprojects to Web Mercator itself
         subprocess.run([
-            'gdal2tiles.py',
-            '-p', 'mercator',    # Mercator projection
-            '-z', '10-16',        # Zoom levels 0 to 18
-            '-w', 'none',        # No world file generation
-            '--xyz',             # XYZ tile naming convention
-            '--processes=4',     # Parallel processing
-            '-r', 'bilinear',    # Bilinear resampling for smoother transitions
-            '--webviewer=none',  # No web viewer
-            '-b', bounds_str,    # Use precise bounds
+            'gdal_translate',
+            '-of', 'MBTILES',
+            '-co', 'TILE_FORMAT=PNG',        # PNG format for lossless compression
+            '-co', 'RESAMPLING=BILINEAR',    # Bilinear resampling for smoother transitions
+            '-co', 'ZOOM_LEVEL_STRATEGY=UPPER',  # Round up to the next zoom level so no native detail is lost
+            '-b', '1', '-b', '2', '-b', '3',  # RGB only; the viewer doesn't use NAIP's NIR band
             input_tif,
-            tiles_dir
-        ], check=True)
-
-        # Create MBTiles
-        subprocess.run([
-            'mb-util',
-            '--image_format=png',  # PNG format for lossless compression
-            '--scheme=xyz',         # XYZ tile scheme
-            tiles_dir,
             output_mbtiles
-        ], check=True)
-
-        # Add metadata
+        ], check=True, env={**os.environ, **VSICURL_ENV, **TILING_ENV})
+
+        # Build the lower zoom levels in place, counting from the zoom the driver actually wrote;
+        # tiling cost doubles per level, so stop MAX_OVERVIEW_LEVELS below it
+        max_zoom = mbtiles_native_zoom(output_mbtiles)
+        min_zoom = max(MIN_OVERVIEW_ZOOM, max_zoom - MAX_OVERVIEW_LEVELS)
+        print(f"Native zoom {max_zoom}; building overviews down to zoom {min_zoom}")
+        overview_factors = mbtiles_overview_factors(output_mbtiles, min_zoom, native_zoom=max_zoom)
+        if overview_factors:
+            subprocess.run([
+                'gdaladdo',
+                '-r', 'bilinear',
+                output_mbtiles,
+                *overview_factors
+            ], check=True, env={**os.environ, **TILING_ENV})
+
+        # Add metadata; the file is rebuilt from scratch on failure, so skip fsyncs
         conn = sqlite3.connect(output_mbtiles)
-        c = conn.cursor()
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS metadata 
-                     (name text, value text)''')
+        conn.executescript('PRAGMA synchronous=OFF; PRAGMA temp_store=MEMORY;')
         
-        # Extract filename details for metadata
-        filename = os.path.basename(input_tif)
+        # Extract filename details for metadata (dropping any SAS query string from remote inputs)
+        filename = os.path.basename(input_tif.split('?')[0])
         
         # Try to extract year from filename (adjust regex as needed)
         year_match = re.search(r'(\d{4})', filename)
         year = year_match.group(1) if year_match else 'Unknown'
         
+        # bounds, format, minzoom and maxzoom are written by the driver from the actual tiles
         metadata = [
             ('name', filename),
             ('type', 'overlay'),
             ('version', '1.1'),
-            ('format', 'png'),
-            ('bounds', bounds_str),  # Use precise bounds
-            ('minzoom', '10'),
-            ('maxzoom', '16'),
             ('year', year)
         ]
         
-        c.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', metadata)
-        conn.commit()
-        conn.close()
+        try:
+            with conn:
+                conn.execute('''CREATE TABLE IF NOT EXISTS metadata 
+                                (name text, value text)''')
+                # The driver's metadata table has no unique key, so clear the rows being replaced
+                conn.executemany('DELETE FROM metadata WHERE name = ?', [(name,) for name, _ in metadata])
+                conn.executemany('INSERT INTO metadata VALUES (?, ?)', metadata)
+                # Index tile lookups for serving unless the tiles table already carries one
+                is_table = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tiles'").fetchone()
+                if is_table and not conn.execute('PRAGMA index_list(tiles)').fetchall():
+                    conn.execute('CREATE INDEX IF NOT EXISTS tiles_zyx ON tiles (zoom_level, tile_row, tile_column)')
+        finally:
+            conn.close()
 
         return True
 
@@ -319,10 +465,6 @@ def convert_to_mbtiles(input_tif, output_mbtiles):
         print(f"Unexpected error during conversion: {e}")
         traceback.print_exc()  # Add detailed error traceback
         return False
-    finally:
-        # Always cleanup
-        if os.path.exists(tiles_dir):
-            subprocess.run(['rm', '-rf', tiles_dir])
 
 def main():
     # Setup signal handler for graceful shutdown
@@ -346,37 +488,87 @@ def main():
             print("No NAIP images found.")
             return
 
-        for i, url in enumerate(tif_urls, 1):
-            if tracker.is_completed(url):
-                print(f"\nSkipping already completed image {i} of {len(tif_urls)}")
-                continue
-
-            print(f"\nProcessing image {i} of {len(tif_urls)}")
-            temp_tif = os.path.join(output_dir, f"temp_ky_{i}.tif")
-            output_mbtiles = os.path.join(output_dir, f"kentucky_{i}.mbtiles")
-
-            # Get signed URL with retries
-            max_attempts = 3
-            signed_url = None
-            for attempt in range(max_attempts):
-                signed_url = get_signed_url(url)
-                if signed_url:
-                    break
-                if attempt < max_attempts - 1:
-                    print(f"Failed to get signed URL, retrying in 10 seconds...")
-                    time.sleep(10)
-
-            if not signed_url:
-                print(f"Could not get signed URL for image {i} after {max_attempts} attempts")
-                continue
-
-            # Download with timeout and progress tracking
-            if download_with_progress(signed_url, temp_tif, max_retries=3, timeout=300):
-                if os.path.exists(temp_tif):
-                    print(f"Converting TIF {i} to MBTiles...")
-                    if convert_to_mbtiles(temp_tif, output_mbtiles):
+        # All images go into one mosaic, so a rerun only has work to do if any image is missing
+        if all(tracker.is_completed(url) for url in tif_urls):
+            print("\nAll images already processed")
+            return
+
+        # NAIP is published as Cloud-Optimized GeoTIFFs, so by default GDAL tiles straight from
+        # the signed URL and range-reads only what each zoom level needs. Set NAIP_DOWNLOAD_TIFS=1
+        # to download each TIF first instead.
+        download_tifs = os.environ.get('NAIP_DOWNLOAD_TIFS') == '1'
+        # With AZURE_STORAGE_SAS_TOKEN set (e.g. on a VM in the data's Azure region), GDAL reads
+        # the blobs over /vsiaz/ using that token, so no per-image signing request is needed
+        use_vsiaz = bool(os.environ.get('AZURE_STORAGE_SAS_TOKEN')) and not download_tifs
+        if use_vsiaz:
+            # GDAL reads the account from the environment, and one SAS token only covers one account
+            azure_account = os.environ.setdefault('AZURE_STORAGE_ACCOUNT', get_storage_account(tif_urls[0]))
+
+        sources = {}
+        dl_workers = min(4, os.cpu_count() or 1)  # Cap concurrent downloads at the core count
+        with ThreadPoolExecutor(max_workers=dl_workers) as dl_pool:
+            download_futures = {}
+            for i, url in enumerate(tif_urls, 1):
+                print(f"\nPreparing image {i} of {len(tif_urls)}")
+                temp_tif = os.path.join(output_dir, f"temp_ky_{i}.tif")
+
+                if use_vsiaz:
+                    vsiaz_path = get_vsiaz_path(url, azure_account)
+                    if vsiaz_path:
+                        sources[url] = vsiaz_path
+                    else:
+                        print(f"Skipping image {i}: it is not in storage account {azure_account}")
+                    continue
+
+                if download_tifs:
+                    # Sign inside the worker so signing overlaps with other images' downloads
+                    download_futures[dl_pool.submit(_download_one, url, temp_tif)] = url
+                    continue
+
+                # Get signed URL with retries; it is signed just before tiling and must last through it
+                max_attempts = 3
+                signed_url = None
+                for attempt in range(max_attempts):
+                    signed_url = get_signed_url(url, min_ttl=TILING_TOKEN_TTL)
+                    if signed_url:
+                        break
+                    if attempt < max_attempts - 1:
+                        print(f"Failed to get signed URL, retrying in 10 seconds...")
+                        time.sleep(10)
+
+                if not signed_url:
+                    print(f"Could not get signed URL for image {i} after {max_attempts} attempts")
+                    continue
+
+                sources[url] = f"/vsicurl/{signed_url}"
+
+            for future in as_completed(download_futures):
+                temp_tif = future.result()
+                if temp_tif:
+                    sources[download_futures[future]] = temp_tif
+
+        if not sources:
+            print("No NAIP images could be prepared for tiling.")
+            return
+
+        # Mosaic every image into one VRT and tile it once, so GDAL startup and the
+        # pyramid are paid for once rather than per image
+        output_mbtiles = os.path.join(output_dir, "kentucky.mbtiles")
+        mosaic_vrt = os.path.join(output_dir, "kentucky_mosaic.vrt")
+        try:
+            if build_mosaic_vrt(list(sources.values()), mosaic_vrt):
+                print(f"Converting mosaic of {len(sources)} TIFs to MBTiles...")
+                if convert_to_mbtiles(mosaic_vrt, output_mbtiles):
+                    for url in sources:
                         tracker.mark_completed(url)
-                    #os.remove(temp_tif)
+        finally:
+            # The VRT embeds signed URLs, so don't leave it behind
+            if os.path.exists(mosaic_vrt):
+                os.remove(mosaic_vrt)
+            # Downloaded TIFs are re-fetched on a rerun, so drop them now
+            for source in sources.values():
+                if os.path.exists(source):
+                    os.remove(source)
 
         print("\nProcessing complete. Output files:")
         print(os.listdir(output_dir))
@@ -1,94 +1,267 @@
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import sys
 import os
-import threading
 import time
 import zipfile
+import tempfile
 import logging
 import subprocess
 import shutil
+import sqlite3
+import hashlib
 from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from osgeo import gdal
 
 maxthreads = 5
-sema = threading.Semaphore(value=maxthreads)
-threads = []
+DOWNLOAD_EXTENSIONS = ('.zip', '.tif')  # '.jpg', '.jpeg', '.jp2',
+IMAGE_EXTENSIONS = ('.tif', '.jpg', '.jpeg', '.jp2')
+CHUNKED_VRT_MIN_FILES = 1000  # Below this a single BuildVRT is quicker than starting worker processes
 path = "naip_output/new"
+# Applied by GDAL's SQLite layer while it writes MBTiles tiles: WAL and relaxed syncing instead of an fsync per commit.
+# page_size comes first because it only takes effect on a new file, before WAL is switched on
+MBTILES_SQLITE_PRAGMA = 'page_size=65536,journal_mode=WAL,synchronous=NORMAL,temp_store=MEMORY,cache_size=-262144'
 processed_dir = os.path.join(path, "processed")
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+api_cache_dir = os.path.join(path, ".api_cache")
+API_CACHE_VERSION = 1  # Bump to invalidate cached API responses
+
+# Kentucky search area; adjacent repeated vertices are dropped and the ring closed once at import
+_KENTUCKY_VERTICES = (
+    (-89.080550458766368, 37.080322330226032),
+    (-88.955417979910038, 36.599550174620148),
+    (-88.593192383220668, 37.03422089064739),
+    (-86.920368718509778, 37.324001367998882),
+    (-85.67562984988632, 37.383274647457142),
+    (-84.812874337771646, 37.705984724507665),
+    (-84.667984099095889, 37.093494170105643),
+    (-85.089482975243527, 37.021049050767772),
+    (-85.135584414822162, 36.876158812092029),
+    (-84.635054499396858, 36.974947611189123),
+    (-83.607650988787015, 36.54686281510169),
+    (-82.145576762149943, 36.95518985136971),
+    (-82.902957555227701, 37.021049050767772),
+    (-84.114766824152127, 37.910148242641675),
+    (-83.403487470653005, 38.219686479812587),
+    (-83.798642667041406, 38.733388235117509),
+    (-84.378203621744404, 38.838762954154411),
+    (-85.063139295484291, 38.772903754756349),
+    (-85.405607132354234, 38.779489674696151),
+    (-85.405607132354234, 38.779489674696151),
+    (-87.328695754777783, 37.929906002461095),
+    (-87.993873668698257, 37.752086164086315),
+    (-87.993873668698257, 37.752086164086315),
+    (-87.993873668698257, 37.752086164086315),
+    (-89.080550458766368, 37.080322330226032),
+)
+KENTUCKY_RING = [list(v) for i, v in enumerate(_KENTUCKY_VERTICES) if i == 0 or v != _KENTUCKY_VERTICES[i - 1]]
+if KENTUCKY_RING[0] != KENTUCKY_RING[-1]:
+    KENTUCKY_RING.append(KENTUCKY_RING[0])
+
+# Shared by the API calls (including the download-retrieve poll) and the download workers, so
+# connections are kept alive instead of paying a TCP+TLS handshake per request
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.5)))
+SESSION.headers.update({'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+gdal.UseExceptions()
 
 def run_command(command):
     start_time = time.time()
     try:
         result = subprocess.run(command, check=True, capture_output=True, text=True)
         end_time = time.time()
-        logging.info(f"Command completed in {end_time - start_time:.2f} seconds: {' '.join(command[:2])}...")
+        logging.info("Command completed in %.2f seconds: %s...", end_time - start_time, ' '.join(command[:2]))
         return result
     except subprocess.CalledProcessError as e:
         end_time = time.time()
-        logging.error(f"Command failed in {end_time - start_time:.2f} seconds: {' '.join(command[:2])}...")
-        logging.error(f"Error output: {e.stderr}")
+        logging.error("Command failed in %.2f seconds: %s...", end_time - start_time, ' '.join(command[:2]))
+        logging.error("Error output: %s", e.stderr)
         return e
 
 
+def dedupe_mbtiles_tiles(conn):
+    # Flat areas (water, nodata) produce the same tile blob thousands of times; store each blob once in
+    # images and point map rows at it, exposing the standard tiles schema as a view over the two
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tiles'").fetchone() is None:
+        return
+    conn.create_function('tile_hash', 1, lambda data: hashlib.md5(data).digest(), deterministic=True)
+    # Plain execute() calls: executescript() would commit the caller's open transaction first
+    conn.execute('CREATE TABLE images (tile_id INTEGER PRIMARY KEY, tile_hash BLOB UNIQUE, tile_data BLOB)')
+    conn.execute('INSERT OR IGNORE INTO images (tile_hash, tile_data) SELECT tile_hash(tile_data), tile_data FROM tiles')
+    conn.execute('''CREATE TABLE map (
+                        zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id INTEGER,
+                        PRIMARY KEY (zoom_level, tile_column, tile_row)
+                    ) WITHOUT ROWID''')
+    conn.execute('''INSERT INTO map
+                    SELECT tiles.zoom_level, tiles.tile_column, tiles.tile_row, images.tile_id
+                    FROM tiles JOIN images ON images.tile_hash = tile_hash(tiles.tile_data)''')
+    conn.execute('DROP TABLE tiles')
+    conn.execute('''CREATE VIEW tiles AS
+                    SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data
+                    FROM map JOIN images ON images.tile_id = map.tile_id''')
+
+def finalize_mbtiles(mbtiles_path, min_zoom=1, max_zoom=16):
+    conn = sqlite3.connect(mbtiles_path, isolation_level=None)
+    try:
+        # Fold the WAL left by the tile writes back into the file and ship it with a rollback journal,
+        # so readers don't need write access next to it
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.executescript('PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-262144;')
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute("UPDATE metadata SET value=? WHERE name='minzoom'", (str(min_zoom),))
+        conn.execute("UPDATE metadata SET value=? WHERE name='maxzoom'", (str(max_zoom),))
+        dedupe_mbtiles_tiles(conn)
+        conn.execute('COMMIT')
+        # VACUUM can't run inside a transaction, so it goes after the commit
+        conn.execute('VACUUM')
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+# cgroup v2 and v1 memory limits; inside a container these, not the host's RAM, decide when we get OOM-killed
+CGROUP_MEMORY_LIMIT_FILES = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+
+def total_memory_bytes():
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        total = 8 * 1024 ** 3  # sysconf is POSIX-only; assume a modest 8 GiB elsewhere
+    for limit_file in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(limit_file, 'r') as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():  # 'max' (v2) means unlimited; v1 reports unlimited as a huge number, which min() ignores
+            total = min(total, int(limit))
+    return total
+
+def list_tif_files(directory):
+    return [entry.path for entry in os.scandir(directory) if entry.is_file() and entry.name.lower().endswith('.tif')]
+
+def _probe_tif(tif_path):
+    try:
+        ds = gdal.Open(tif_path)
+        return ds is not None and ds.RasterCount > 0
+    except RuntimeError:
+        return False
+
+def validate_tifs(tif_files):
+    # Truncated downloads would otherwise fail the mosaic mid-run; gdal.Open releases the GIL, so probe in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        valid = [tif for tif, ok in zip(tif_files, executor.map(_probe_tif, tif_files)) if ok]
+    for tif in set(tif_files) - set(valid):
+        logging.warning("Skipping unreadable TIF: %s", tif)
+    return valid
+
+def _build_vrt(vrt_path, tif_files, **options):
+    return gdal.BuildVRT(
+        vrt_path, tif_files,
+        resampleAlg='cubic',  # High-quality resampling
+        resolution='highest',  # Preserve highest resolution
+        **options,
+    )
+
+def _tif_west_edge(tif_path):
+    return gdal.Open(tif_path).GetGeoTransform()[0]
+
+def _build_chunk_vrt(vrt_path, tif_files):
+    _build_vrt(vrt_path, tif_files)  # Dropping the dataset flushes the VRT to disk
+    return vrt_path
+
+def build_mosaic_vrt(tif_files):
+    # BuildVRT is single-threaded, so for large scene counts build one VRT per chunk of inputs in
+    # separate processes and mosaic those; returns the in-memory VRT and the chunk files to clean up
+    if len(tif_files) < CHUNKED_VRT_MIN_FILES:
+        return _build_vrt('', tif_files), []
+
+    # Split west to east into contiguous strips so each chunk VRT only spans its own scenes
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        west_edges = list(executor.map(_tif_west_edge, tif_files))
+    tif_files = [tif for _, tif in sorted(zip(west_edges, tif_files))]
+    num_chunks = max(2, (os.cpu_count() or 2) // 2)
+    chunk_size = -(-len(tif_files) // num_chunks)
+    chunks = [tif_files[i:i + chunk_size] for i in range(0, len(tif_files), chunk_size)]
+    chunk_vrts = [os.path.join(processed_dir, f"chunk_{i}.vrt") for i in range(len(chunks))]
+    logging.info("Building %d chunk VRTs over %d TIFs...", len(chunks), len(tif_files))
+    with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(_build_chunk_vrt, chunk_vrts, chunks))
+    # Each chunk VRT reads 0 outside its scenes across the rest of its extent; treat 0 as nodata so that
+    # padding never paints over a neighbouring chunk, but hide it so the mosaic matches a flat BuildVRT
+    return _build_vrt('', chunk_vrts, srcNodata=0, hideNodata=True), chunk_vrts
+
 def process_downloaded_tifs(tif_files):
     os.makedirs(processed_dir, exist_ok=True)
-    
-    # Create VRT maintaining original resolution and projection
-    logging.info("Creating VRT file...")
-    vrt_file = os.path.join(processed_dir, "merged.vrt")
-    gdalbuildvrt_command = [
-        'gdalbuildvrt',
-        '-overwrite',
-        '-r', 'cubic',  # High-quality resampling
-        '-resolution', 'highest',  # Preserve highest resolution
-        vrt_file
-    ] + tif_files
-
-    if run_command(gdalbuildvrt_command).returncode != 0:
-        return
 
-    # Convert to EPSG:3857 while preserving original resolution
-    logging.info("Running gdalwarp...")
-    clipped_file = os.path.join(processed_dir, "warped.tif")
-    gdalwarp_command = [
-        'gdalwarp',
-        '-r', 'cubic',  # Highest quality resampling
-        '-of', 'GTiff',
-        '-co', 'TILED=YES',
-        '-co', 'BLOCKXSIZE=256',  # Standard tile size
-        '-co', 'BLOCKYSIZE=256',  # Standard tile size
-        '-co', 'COMPRESS=LZW',  # Lossless compression
-        '-co', 'PREDICTOR=2',  # Horizontal differencing predictor for better compression
-        '-co', 'BIGTIFF=YES',
-        '-t_srs', 'EPSG:3857',
-        '-tr', '2.39', '2.39',  # Resolution for zoom level 16
-        '-tap',
-        '-multi',
-        '-wo', 'NUM_THREADS=ALL_CPUS',
-        vrt_file,
-        clipped_file
-    ]
-
-    if run_command(gdalwarp_command).returncode != 0:
+    tif_files = validate_tifs(tif_files)
+    if not tif_files:
+        logging.error("No readable TIF files to process")
         return
-
-    # Convert to MBTiles with highest quality
-    logging.info("Converting to MBTiles...")
+    
+    # The mosaic and the reprojection stay in-memory VRT datasets handed from step to step, so
+    # pixels stream from the source TIFs into the MBTiles encoder without a warped GeoTIFF on disk
     final_mbtiles = os.path.join(processed_dir, "final_merge_raster.mbtiles")
-    gdal_translate_command = [
-        'gdal_translate', 
-        '-of', 'MBTILES',
-        '-co', 'TILE_FORMAT=JPEG',
-        '-co', 'RESAMPLING=CUBIC',
-        '-co', 'QUALITY=100',
-        clipped_file, 
-        final_mbtiles
-    ]
-
-    if run_command(gdal_translate_command).returncode != 0:
+    vrt_ds = warped_ds = None
+    chunk_vrts = []
+    # -multi/NUM_THREADS only split the warp between I/O and compute; this lets GDAL's own
+    # kernels and the tile encoder use every core too
+    gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    gdal.SetThreadLocalConfigOption('OGR_SQLITE_PRAGMA', MBTILES_SQLITE_PRAGMA)
+    # The default block cache is ~5% of RAM, which makes the warper re-read source blocks; the warped
+    # VRT is evaluated while tiles are written, so give the cache half of RAM and the warper a quarter
+    total_memory = total_memory_bytes()
+    gdal.SetCacheMax(total_memory // 2)
+    # In bytes: GDAL reads -wm values of 10000 or more as bytes, so a megabyte count would shrink the buffer
+    warp_memory = total_memory // 4
+    try:
+        # Create VRT maintaining original resolution and projection
+        logging.info("Creating VRT...")
+        vrt_ds, chunk_vrts = build_mosaic_vrt(tif_files)
+
+        # Convert to EPSG:3857 while preserving original resolution
+        logging.info("Reprojecting to EPSG:3857...")
+        warped_ds = gdal.Warp(
+            '', vrt_ds,
+            format='VRT',
+            resampleAlg='cubic',  # Highest quality resampling
+            dstSRS='EPSG:3857',
+            xRes=2.39, yRes=2.39,  # Resolution for zoom level 16
+            targetAlignedPixels=True,
+            multithread=True,
+            warpOptions=['NUM_THREADS=ALL_CPUS'],
+            warpMemoryLimit=warp_memory,  # Larger warp chunks, fewer passes over the sources
+        )
+        # Overviews below one 256px tile across would only re-walk blocks for nothing
+        longest_side = max(warped_ds.RasterXSize, warped_ds.RasterYSize)
+        overview_levels = [str(2 ** i) for i in range(1, 15) if longest_side // 2 ** i >= 256]
+
+        # Convert to MBTiles with highest quality
+        logging.info("Converting to MBTiles...")
+        gdal.Translate(
+            final_mbtiles, warped_ds,
+            format='MBTILES',
+            creationOptions=[
+                'TILE_FORMAT=JPEG',
+                'RESAMPLING=CUBIC',
+                'QUALITY=100',
+            ],
+        )
+    except RuntimeError as e:
+        logging.error("Failed to create %s: %s", final_mbtiles, e)
         return
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+        gdal.SetThreadLocalConfigOption('OGR_SQLITE_PRAGMA', None)
+        warped_ds = vrt_ds = None
+        for chunk_vrt in chunk_vrts:
+            if os.path.exists(chunk_vrt):
+                os.remove(chunk_vrt)
 
     # Add comprehensive overviews
     logging.info("Adding overviews...")
@@ -96,106 +269,116 @@ def process_downloaded_tifs(tif_files):
         'gdaladdo', 
         '-r', 'cubic',  # Highest quality overview resampling
         '--config', 'COMPRESS_OVERVIEW', 'LZW',
+        '--config', 'GDAL_NUM_THREADS', 'ALL_CPUS',  # Use all CPUs for faster processing
+        '--config', 'OGR_SQLITE_PRAGMA', MBTILES_SQLITE_PRAGMA,
         final_mbtiles,
-        '2', '4', '8', '16', '32', '64', '128', '256', '512', '1024', '2048', '4096', '8192', '16384'
-    ]
-    run_command(gdaladdo_mbtiles_command)
+    ] + overview_levels
+    if overview_levels:
+        run_command(gdaladdo_mbtiles_command)
 
     # Ensure full zoom range in metadata
     logging.info("Updating zoom levels in metadata...")
-    sqlite_command = [
-        'sqlite3', 
-        final_mbtiles, 
-        "UPDATE metadata SET value='1' WHERE name='minzoom';" +
-        "UPDATE metadata SET value='16' WHERE name='maxzoom';" +
-        "VACUUM;"
-    ]
-    run_command(sqlite_command)
+    try:
+        finalize_mbtiles(final_mbtiles)
+    except sqlite3.Error as e:
+        logging.error("Failed to finalize %s: %s", final_mbtiles, e)
 
-    logging.info(f"Process complete. Output files in {processed_dir}")
+    logging.info("Process complete. Output files in %s", processed_dir)
 
 def sendRequest(url, data, apiKey=None):  
-    headers = {'Content-Type': 'application/json'}
-    if apiKey:
-        headers['X-Auth-Token'] = apiKey
+    headers = {'X-Auth-Token': apiKey} if apiKey else None
     
-    response = requests.post(url, json=data, headers=headers)    
+    response = SESSION.post(url, json=data, headers=headers, timeout=30)    
     output = response.json()
     
     if output['errorCode'] is not None:
-        print(f"Error: {output['errorCode']} - {output['errorMessage']}")
+        logging.error("Error: %s - %s", output['errorCode'], output['errorMessage'])
         sys.exit(1)
     
     return output['data']
 
+def cachedRequest(url, data, apiKey=None, ttl=86400):
+    # Only for deterministic lookups (scene-search, download-options): reruns with the same
+    # request body reuse the stored response instead of hitting the rate-limited API again
+    key_source = f"{API_CACHE_VERSION}:{url}:{json.dumps(data, sort_keys=True)}".encode()
+    cache_path = os.path.join(api_cache_dir, hashlib.blake2b(key_source, digest_size=16).hexdigest() + '.json')
+    try:
+        if time.time() - os.path.getmtime(cache_path) < ttl:
+            with open(cache_path, 'r') as f:
+                logging.info("Using cached response for %s", url)
+                return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        pass
+
+    output = sendRequest(url, data, apiKey)
+    os.makedirs(api_cache_dir, exist_ok=True)
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(output, f)
+    os.replace(temp_path, cache_path)
+    return output
+
 def downloadFile(url, dataset='naip'):
-    sema.acquire()
     try:        
-        response = requests.get(url, stream=True, timeout=60)
+        response = SESSION.get(url, stream=True, timeout=60)
         content_disp = response.headers.get('content-disposition', '')
         if 'filename=' not in content_disp:
-            sema.release()
             return
             
         filename = content_disp.split('filename=')[1].strip('"')
         
         # Download ZIP, JPEG, JP2, and TIF files
-        allowed_extensions = ['.zip', '.tif'] # '.jpg', '.jpeg', '.jp2',
-        if not any(filename.lower().endswith(ext) for ext in allowed_extensions):
-            print(f"Skipping file: {filename}")
-            sema.release()
+        if not filename.lower().endswith(DOWNLOAD_EXTENSIONS):
+            logging.info("Skipping file: %s", filename)
             return
             
         os.makedirs(path, exist_ok=True)
         full_path = os.path.join(path, filename)
         
-        print(f"Downloading file: {filename}")
-        with open(full_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        print(f"Successfully downloaded file: {filename}")
+        logging.info("Downloading file: %s", filename)
+        # Copy in 1 MiB blocks; 8 KiB chunks spent most of the time in the Python loop
+        response.raw.decode_content = True
+
+        if filename.lower().endswith('.zip'):
+            # Spool the archive (in memory up to 256 MiB) and extract straight from it,
+            # instead of writing the ZIP into path, re-reading it and deleting it
+            with tempfile.SpooledTemporaryFile(max_size=256 * 1024 * 1024) as archive:
+                shutil.copyfileobj(response.raw, archive, length=1024 * 1024)
+                logging.info("Successfully downloaded file: %s", filename)
+                try:
+                    archive.seek(0)
+                    with zipfile.ZipFile(archive, 'r') as zip_ref:
+                        for file in zip_ref.namelist():
+                            if file.lower().endswith(IMAGE_EXTENSIONS):
+                                logging.info("Extracting: %s", file)
+                                zip_ref.extract(file, path)
+                    logging.info("Extracted contents of ZIP: %s", filename)
+                except Exception as ze:
+                    logging.error("Error processing file %s: %s", filename, ze)
+            return
 
-        # Extract and handle different file types
-        try:
-            if filename.lower().endswith('.zip'):
-                with zipfile.ZipFile(full_path, 'r') as zip_ref:
-                    for file in zip_ref.namelist():
-                        if any(file.lower().endswith(ext) for ext in ['.tif', '.jpg', '.jpeg', '.jp2']):
-                            print(f"Extracting: {file}")
-                            zip_ref.extract(file, path)
-                os.remove(full_path)
-                print(f"Extracted contents and removed ZIP: {filename}")
-            elif filename.lower().endswith(('.jpg', '.jpeg', '.jp2', '.tif')):
-                # For direct image downloads, keep the file
-                print(f"Saved image file: {filename}")
-        except Exception as ze:
-            print(f"Error processing file {filename}: {str(ze)}")
-        
-        sema.release()
+        # For direct image downloads, keep the file
+        with open(full_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+        logging.info("Successfully downloaded file: %s", filename)
+        logging.info("Saved image file: %s", filename)
         
     except Exception as e:
-        print(f"Error downloading {url}: {str(e)}")
-        sema.release()
-
-def runDownload(url):
-    thread = threading.Thread(target=downloadFile, args=(url,))
-    threads.append(thread)
-    thread.start()
+        logging.error("Error downloading %s: %s", url, e)
 
 def main():
     # Create output directory if it doesn't exist
     os.makedirs(path, exist_ok=True)
 
     # Check for existing TIF files
-    existing_tif_files = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.tif')]
+    existing_tif_files = list_tif_files(path)
     
     if existing_tif_files:
-        print("\nExisting TIF files found:")
+        logging.info("Existing TIF files found:")
         for tif in existing_tif_files:
-            print(f"- {os.path.basename(tif)}")
+            logging.info("- %s", os.path.basename(tif))
         
-        print("\nSkipping download. Proceeding to GDAL processing...")
+        logging.info("Skipping download. Proceeding to GDAL processing...")
         process_downloaded_tifs(existing_tif_files)
         return
 
@@ -204,11 +387,11 @@ def main():
     token = ''
     serviceUrl = "https://m2m.cr.usgs.gov/api/api/json/stable/"
     
-    print("Logging in...")
+    logging.info("Logging in...")
     apiKey = sendRequest(serviceUrl + "login-token", {'username': username, 'token': token})
 
-    print("Getting scenes...")
-    scenes = sendRequest(serviceUrl + "scene-search", {
+    logging.info("Getting scenes...")
+    scenes = cachedRequest(serviceUrl + "scene-search", {
         'datasetName': 'naip',
         'maxResults': 20,
         'sceneFilter': {
@@ -220,33 +403,7 @@ def main():
                 'filterType': 'geojson',
                 'geoJson': {
                     'type': 'Polygon',
-                    'coordinates': [[
-                        [-89.080550458766368, 37.080322330226032],
-                        [-88.955417979910038, 36.599550174620148],
-                        [-88.593192383220668, 37.03422089064739],
-                        [-86.920368718509778, 37.324001367998882],
-                        [-85.67562984988632, 37.383274647457142],
-                        [-84.812874337771646, 37.705984724507665],
-                        [-84.667984099095889, 37.093494170105643],
-                        [-85.089482975243527, 37.021049050767772],
-                        [-85.135584414822162, 36.876158812092029],
-                        [-84.635054499396858, 36.974947611189123],
-                        [-83.607650988787015, 36.54686281510169],
-                        [-82.145576762149943, 36.95518985136971],
-                        [-82.902957555227701, 37.021049050767772],
-                        [-84.114766824152127, 37.910148242641675],
-                        [-83.403487470653005, 38.219686479812587],
-                        [-83.798642667041406, 38.733388235117509],
-                        [-84.378203621744404, 38.838762954154411],
-                        [-85.063139295484291, 38.772903754756349],
-                        [-85.405607132354234, 38.779489674696151],
-                        [-85.405607132354234, 38.779489674696151],
-                        [-87.328695754777783, 37.929906002461095],
-                        [-87.993873668698257, 37.752086164086315],
-                        [-87.993873668698257, 37.752086164086315],
-                        [-87.993873668698257, 37.752086164086315],
-                        [-89.080550458766368, 37.080322330226032]
-                    ]]
+                    'coordinates': [KENTUCKY_RING]
                 }
             }
         }
@@ -254,8 +411,8 @@ def main():
 
     sceneIds = [result['entityId'] for result in scenes['results']]
     
-    print("\nGetting download options...")
-    downloadOptions = sendRequest(serviceUrl + "download-options", 
+    logging.info("Getting download options...")
+    downloadOptions = cachedRequest(serviceUrl + "download-options", 
                                 {
                                     'datasetName': 'naip', 
                                     'entityIds': sceneIds,
@@ -275,35 +432,52 @@ def main():
             })
 
     if not downloads:
-        print("No downloads available!")
+        logging.warning("No downloads available!")
         return
 
-    print(f"\nRequesting downloads...")
+    logging.info("Requesting downloads...")
     requestResults = sendRequest(serviceUrl + "download-request", {'downloads': downloads, 'label': 'naip_download'},apiKey)
 
-    max_attempts = 6000
+    available_urls = []
+    # Downloads the request queued for preparation; download-retrieve reports those still pending under 'requested'
+    preparing = requestResults.get('preparingDownloads') or []
+    # Poll quickly at first, then back off so a slow queue isn't hammered
+    max_wait = 7200
+    delay = 2.0
+    waited = 0.0
     attempt = 0
-    while attempt < max_attempts:
-        print(f"\nChecking download status (attempt {attempt + 1}/{max_attempts})...")
+    while waited < max_wait:
+        attempt += 1
+        logging.info("Checking download status (attempt %d, %.0fs elapsed)...", attempt, waited)
         downloadUrls = sendRequest(serviceUrl + "download-retrieve", {'label': 'naip_download'}, apiKey)
         
-        if 'available' in downloadUrls and downloadUrls['available']:
+        if downloadUrls.get('available'):
             available_count = len(downloadUrls['available'])
-            if available_count > 0:
-                print(f"Found {available_count} available downloads!")
-                for item in downloadUrls['available']:
-                    runDownload(item['url'])
-                break
+            logging.info("Found %d available downloads!", available_count)
+            available_urls = [item['url'] for item in downloadUrls['available']]
+            break
+
+        pending = downloadUrls['requested'] if 'requested' in downloadUrls else preparing
+        if not pending:
+            logging.warning("Nothing available and nothing being prepared; giving up on polling")
+            break
         
-        print("Downloads not ready yet, waiting 10 seconds...")
-        time.sleep(10)
-        attempt += 1
-
-    print("\nWaiting for downloads to complete...")
-    for thread in threads:
-        thread.join()
-
-    tif_files = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.tif')]
+        logging.info("Downloads not ready yet, waiting %.0f seconds...", delay)
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 1.5, 60)
+
+    logging.info("Waiting for downloads to complete...")
+    # The pool bounds concurrency to maxthreads; downloadFile reports its own errors
+    with ThreadPoolExecutor(max_workers=maxthreads) as executor:
+        futures = {executor.submit(downloadFile, url): url for url in available_urls}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error("Error downloading %s: %s", futures[future], e)
+
+    tif_files = list_tif_files(path)
     tif_list_file = os.path.join(processed_dir, "input_tifs.txt")
 
     # Write TIF files to a text file
@@ -311,15 +485,15 @@ def main():
         for tif in tif_files:
             f.write(f"{tif}\n")
 
-    print(f"TIF files list written to {tif_list_file}")
+    logging.info("TIF files list written to %s", tif_list_file)
     for tif in tif_files:
-        print(f"- {os.path.basename(tif)}")
+        logging.info("- %s", os.path.basename(tif))
     
     if tif_files:
-        print("\nStarting GDAL processing...")
+        logging.info("Starting GDAL processing...")
         process_downloaded_tifs(tif_files)
     else:
-        print("No TIF files found to process")
+        logging.warning("No TIF files found to process")
 
     sendRequest(serviceUrl + "logout", None, apiKey)
 